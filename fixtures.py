@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from types import SimpleNamespace
 from typing import List
@@ -6,13 +7,46 @@ from pyfixtures import fixture
 from virtool_workflow.data_model.indexes import WFIndex
 
 
+def _physical_core_count() -> int:
+    """Count physical cores, falling back to the logical count."""
+    try:
+        cores = set()
+        physical_id = None
+
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("physical id"):
+                    physical_id = line.split(":")[1].strip()
+                elif line.startswith("core id"):
+                    cores.add((physical_id, line.split(":")[1].strip()))
+
+        if cores:
+            return len(cores)
+    except OSError:
+        pass
+
+    return os.cpu_count() or 1
+
+
+@fixture
+def bowtie2_proc(proc: int) -> int:
+    """
+    The process count to pass to bowtie2 alignment commands.
+
+    bowtie2 slows down when run with more threads than physical cores and past
+    roughly 16 threads, so the workflow ``proc`` count is clamped for alignment.
+    ``bowtie2-build`` scales better and keeps the full count.
+    """
+    return min(proc, _physical_core_count(), 16)
+
+
 @fixture
-def index(indexes: List[WFIndex]):
+def index(indexes: List[WFIndex]) -> WFIndex:
     return indexes[0]
 
 
 @fixture
-def intermediate():
+def intermediate() -> SimpleNamespace:
     """A namespace for storing intermediate values."""
     return SimpleNamespace(
         isolate_high_scores={},
@@ -21,7 +55,7 @@ def intermediate():
 
 
 @fixture
-def isolate_path(work_path: Path):
+def isolate_path(work_path: Path) -> Path:
     path = work_path / "isolates"
     path.mkdir()
 
@@ -29,27 +63,27 @@ def isolate_path(work_path: Path):
 
 
 @fixture
-def isolate_fasta_path(isolate_path: Path):
+def isolate_fasta_path(isolate_path: Path) -> Path:
     return isolate_path / "isolate_index.fa"
 
 
 @fixture
-def isolate_fastq_path(isolate_path: Path):
+def isolate_fastq_path(isolate_path: Path) -> Path:
     return isolate_path / "isolate_mapped.fq"
 
 
 @fixture
-def isolate_index_path(isolate_path: Path):
+def isolate_index_path(isolate_path: Path) -> Path:
     return isolate_path / "isolates"
 
 
 @fixture
-def isolate_sam_path(isolate_path: Path):
+def isolate_sam_path(isolate_path: Path) -> Path:
     return isolate_path / "to_isolates.sam"
 
 
 @fixture
-def p_score_cutoff():
+def p_score_cutoff() -> float:
     return 0.01
 
 
@@ -59,7 +93,7 @@ def read_file_names(sample) -> str:
 
 
 @fixture
-def reassigned_sam_path(work_path: Path):
+def reassigned_sam_path(work_path: Path) -> Path:
     """The path to the SAM file after Pathoscope reassignment."""
     return work_path / "reassigned.sam"
 
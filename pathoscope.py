@@ -1,6 +1,7 @@
 import copy
 import csv
 import math
+import numpy
 import rust_utils
 from functools import cached_property
 from pathlib import Path
@@ -494,22 +495,32 @@ def write_report(
     return results
 
 
-def calculate_coverage(sam_path: Path, ref_lengths: Dict[str, int]):
+def calculate_coverage(
+    sam_path: Path, ref_lengths: Dict[str, int]
+) -> Dict[str, numpy.ndarray]:
+    """
+    Calculate a per-position coverage array for each reference in a SAM file.
+
+    :param sam_path: the path to the SAM file
+    :param ref_lengths: the lengths of the reference sequences keyed by id
+    :return: int32 coverage arrays keyed by reference id
+
+    """
     coverage_dict = {}
     pos_length_list = []
 
     for line in parse_sam(sam_path):
-        coverage_dict[line.ref_id] = [0] * ref_lengths[line.ref_id]
+        coverage_dict[line.ref_id] = numpy.zeros(
+            ref_lengths[line.ref_id], dtype=numpy.int32
+        )
         pos_length_list.append((line.ref_id, line.position, line.read_length))
 
     for ref_id, pos, length in pos_length_list:
         start_index = pos - 1
 
-        for i in range(start_index, start_index + length):
-            try:
-                coverage_dict[ref_id][i] += 1
-            except IndexError:
-                pass
+        # Slices clamp at the end of the array, so alignments running off the end of
+        # the reference are truncated like the old per-position IndexError handling.
+        coverage_dict[ref_id][start_index : start_index + length] += 1
 
     return coverage_dict
 
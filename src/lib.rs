@@ -13,9 +13,63 @@ use std::{
 fn rust_utils(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(run_expectation_maximization, m)?)?;
     m.add_function(wrap_pyfunction!(run_eliminate_subtraction, m)?)?;
+    m.add_function(wrap_pyfunction!(collect_sam_ref_ids, m)?)?;
     return Ok(());
 }
 
+#[pyfunction]
+///Collect reference ids from a chunk of SAM lines.
+///
+///Returns the reference id of every alignment that is mapped, has a reference and
+///meets the score cutoff. Header and comment lines are skipped. The parse loop
+///releases the GIL so it runs in parallel with the event loop.
+pub fn collect_sam_ref_ids(py: Python, chunk: &[u8], p_score_cutoff: f32) -> Vec<String> {
+    return py.allow_threads(move || collect_ref_ids(chunk, p_score_cutoff));
+}
+
+fn collect_ref_ids(chunk: &[u8], p_score_cutoff: f32) -> Vec<String> {
+    let mut ref_ids: Vec<String> = Vec::new();
+
+    for line in chunk.split(|byte| *byte == b'\n') {
+        let l = match std::str::from_utf8(line) {
+            Ok(l) => l,
+            Err(_) => continue,
+        };
+
+        match l.chars().next() {
+            Some(c) => {
+                if c == '@' || c == '#' {
+                    continue;
+                }
+            }
+            None => continue,
+        };
+
+        let fields: Vec<&str> = l.split("\t").collect();
+
+        if fields.len() < 11 {
+            continue;
+        }
+
+        let flag: u32 = match fields[1].parse() {
+            Ok(flag) => flag,
+            Err(_) => continue,
+        };
+
+        if flag & 4 == 4 || fields[2] == "*" {
+            continue;
+        }
+
+        if find_sam_align_score(&fields) < p_score_cutoff {
+            continue;
+        }
+
+        ref_ids.push(fields[2].to_string());
+    }
+
+    return ref_ids;
+}
+
 #[pyfunction]
 ///Entry point for eliminate_subtraction
 pub fn run_eliminate_subtraction(
@@ -1,4 +1,5 @@
 import json
+import os
 import shutil
 from pathlib import Path
 from shutil import copytree
@@ -17,11 +18,22 @@ from virtool_workflow.data_model.samples import Sample, WFSample
 from virtool_workflow.data_model.subtractions import WFSubtraction
 from virtool_workflow.runtime.run_subprocess import run_subprocess as wf_run_subprocess
 
+import pathoscope
+from fixtures import _physical_core_count
 from workflow import (
+    INDEX_CACHE_SIZE,
+    SAM_BATCH_SIZE,
+    UNMAPPED_FLAGS,
+    decompress_reads_command,
     eliminate_subtraction,
+    isolate_index_cache_key,
     map_default_isolates,
     map_isolates,
+    parse_sam_fields,
     reassignment,
+    restore_cached_index,
+    run_with_queued_stdout,
+    update_index_cache,
 )
 
 TEST_DATA_PATH = Path(__file__).parent / "test_files"
@@ -147,6 +159,173 @@ def ref_lengths():
         return json.load(f)
 
 
+def test_physical_core_count():
+    count = _physical_core_count()
+
+    assert 1 <= count <= (os.cpu_count() or 1)
+
+
+def test_decompress_reads_command():
+    command = decompress_reads_command("/data/reads 1.fq.gz,/data/reads_2.fq.gz")
+
+    assert command == "gzip -d -c -f '/data/reads 1.fq.gz' /data/reads_2.fq.gz"
+
+
+@pytest.mark.parametrize("flag", [0, 4, 16, 20, 99, 256, 260, 2048, 2052, 4095])
+def test_unmapped_flags(flag):
+    assert (str(flag).encode() in UNMAPPED_FLAGS) == bool(flag & 0x4)
+
+
+def test_parse_sam_fields(sam_line):
+    """
+    Test that the precompiled patterns extract the same fields as a full tab split.
+    """
+    line = "\t".join(sam_line).encode()
+
+    read_id, flag, ref_id, score = parse_sam_fields(line)
+
+    assert read_id == sam_line[0].encode()
+    assert flag == sam_line[1].encode()
+    assert ref_id == sam_line[2].encode()
+    assert score == pathoscope.find_sam_align_score(sam_line)
+
+
+def test_parse_sam_fields_no_score(sam_line):
+    line = "\t".join(field for field in sam_line if not field.startswith("AS:i:"))
+
+    _, _, _, score = parse_sam_fields(line.encode())
+
+    assert score is None
+
+
+def test_parse_sam_fields_malformed():
+    with pytest.raises(ValueError, match="Malformed SAM line"):
+        parse_sam_fields(b"not a sam line")
+
+
+def write_fake_bowtie2_index(index_path: Path, content: bytes) -> list:
+    """Write fake bowtie2 index files for the given prefix path."""
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+
+    names = [f"{index_path.name}.{i}.bt2" for i in (1, 2)] + [
+        f"{index_path.name}.rev.{i}.bt2" for i in (1, 2)
+    ]
+
+    for name in names:
+        (index_path.parent / name).write_bytes(content + name.encode())
+
+    return sorted(names)
+
+
+def test_isolate_index_cache_key(tmp_path: Path):
+    path_1 = tmp_path / "a.fa"
+    path_2 = tmp_path / "b.fa"
+    path_3 = tmp_path / "c.fa"
+
+    path_1.write_text(">seq1\nATGC\n")
+    path_2.write_text(">seq1\nATGC\n")
+    path_3.write_text(">seq1\nATGG\n")
+
+    assert isolate_index_cache_key(path_1) == isolate_index_cache_key(path_2)
+    assert isolate_index_cache_key(path_1) != isolate_index_cache_key(path_3)
+
+
+def test_index_cache_roundtrip(tmp_path: Path):
+    index_path = tmp_path / "isolates" / "isolates"
+    names = write_fake_bowtie2_index(index_path, b"built")
+
+    cache_path = tmp_path / "bt2_cache"
+
+    update_index_cache(index_path, cache_path, "abc123")
+
+    entry_path = cache_path / "abc123"
+
+    assert sorted(path.name for path in entry_path.iterdir()) == names
+
+    restored_path = tmp_path / "restored" / "isolates"
+    restored_path.parent.mkdir()
+
+    restore_cached_index(entry_path, restored_path)
+
+    for name in names:
+        assert (restored_path.parent / name).read_bytes() == b"built" + name.encode()
+
+
+def test_index_cache_existing_entry(tmp_path: Path):
+    index_path = tmp_path / "isolates" / "isolates"
+    write_fake_bowtie2_index(index_path, b"second")
+
+    cache_path = tmp_path / "bt2_cache"
+
+    entry_path = cache_path / "abc123"
+    entry_path.mkdir(parents=True)
+    (entry_path / "isolates.1.bt2").write_bytes(b"first")
+
+    # A concurrent run already stored this key. The existing entry is kept and the
+    # temp directory is discarded.
+    update_index_cache(index_path, cache_path, "abc123")
+
+    assert (entry_path / "isolates.1.bt2").read_bytes() == b"first"
+    assert not (cache_path / "abc123.tmp").exists()
+
+
+def test_index_cache_eviction(tmp_path: Path):
+    index_path = tmp_path / "isolates" / "isolates"
+    write_fake_bowtie2_index(index_path, b"built")
+
+    cache_path = tmp_path / "bt2_cache"
+
+    for i in range(INDEX_CACHE_SIZE + 2):
+        update_index_cache(index_path, cache_path, f"key{i}")
+        os.utime(cache_path / f"key{i}", (1000 + i, 1000 + i))
+
+    entries = sorted(path.name for path in cache_path.iterdir())
+
+    assert len(entries) == INDEX_CACHE_SIZE
+    assert "key0" not in entries
+    assert "key1" not in entries
+
+
+async def test_run_with_queued_stdout():
+    batches = []
+
+    async def process_batch(batch):
+        batches.append(batch)
+
+    async def run(stdout_handler):
+        for i in range(SAM_BATCH_SIZE + 3):
+            await stdout_handler(b"line-%d" % i)
+
+    await run_with_queued_stdout(run, process_batch)
+
+    assert [len(batch) for batch in batches] == [SAM_BATCH_SIZE, 3]
+    assert batches[0][0] == b"line-0"
+    assert batches[1][-1] == b"line-%d" % (SAM_BATCH_SIZE + 2)
+
+
+async def test_run_with_queued_stdout_propagates_batch_error():
+    async def process_batch(batch):
+        raise ValueError("bad batch")
+
+    async def run(stdout_handler):
+        for _ in range(SAM_BATCH_SIZE * 200):
+            await stdout_handler(b"line")
+
+    with pytest.raises(ValueError, match="bad batch"):
+        await run_with_queued_stdout(run, process_batch, maxsize=2)
+
+
+async def test_run_with_queued_stdout_cancels_worker_when_run_fails():
+    async def process_batch(batch):
+        pass
+
+    async def run(stdout_handler):
+        raise RuntimeError("bowtie2 failed")
+
+    with pytest.raises(RuntimeError, match="bowtie2 failed"):
+        await run_with_queued_stdout(run, process_batch)
+
+
 async def test_map_default_isolates(
     read_file_names, index: WFIndex, run_subprocess, snapshot
 ):
@@ -1,12 +1,16 @@
 import asyncio
+import hashlib
+import os
+import re
 import shlex
 import shutil
-from collections import defaultdict
+from functools import lru_cache
 from logging import getLogger
 from pathlib import Path
 from types import SimpleNamespace
 from typing import Any, Dict, List, TextIO
 
+import numpy
 import rust_utils
 import aiofiles
 import aiofiles.os
@@ -16,12 +20,224 @@ from virtool_workflow.data_model.indexes import WFIndex
 from virtool_workflow.data_model.subtractions import WFSubtraction
 from virtool_workflow.runtime.run_subprocess import RunSubprocess
 
-from pathoscope import SamLine, calculate_coverage
+from pathoscope import calculate_coverage
 from pathoscope import run as run_pathoscope
 from pathoscope import write_report
 
 logger = getLogger("pathoscope")
 
+#: The number of SAM lines to accumulate before flushing to shared state.
+#:
+#: Flushing in batches amortizes per-line handler overhead when tens of millions of
+#: records stream out of bowtie2.
+SAM_BATCH_SIZE = 4096
+
+#: The maximum number of isolate indexes kept in the bowtie2 index cache.
+INDEX_CACHE_SIZE = 8
+
+#: Matches the read id, flag, reference id, and SEQ field of a SAM line.
+SAM_FIELDS_PATTERN = re.compile(
+    rb"([^\t]+)\t(\d+)\t([^\t]+)\t(?:[^\t]*\t){6}([^\t]*)\t"
+)
+
+#: Matches the bowtie2 ``AS:i:`` alignment score tag in the optional SAM fields.
+ALIGN_SCORE_PATTERN = re.compile(rb"\tAS:i:(-?\d+)")
+
+#: The raw FLAG fields with the unmapped bit (0x4) set.
+#:
+#: SAM flags fit in 12 bits, so a membership test against this set replaces the
+#: per-line int conversion and mask in the stdout handlers.
+UNMAPPED_FLAGS = frozenset(str(flag).encode() for flag in range(4096) if flag & 0x4)
+
+
+def isolate_index_cache_key(fasta_path: Path) -> str:
+    """
+    Derive the cache key for an isolate index from the isolate FASTA content.
+
+    Hashing the written FASTA rather than the selected sequence ids means a
+    reference update that changes sequence data invalidates the cached index.
+
+    :param fasta_path: the path to the isolate FASTA file
+    :return: the cache key
+
+    """
+    digest = hashlib.blake2b(digest_size=12)
+
+    with open(fasta_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def restore_cached_index(entry_path: Path, isolate_index_path: Path):
+    """
+    Copy a cached bowtie2 index to the isolate index location.
+
+    The cache entry's mtime is refreshed before copying so a concurrent eviction
+    pass sees the entry as fresh instead of removing it mid-restore.
+
+    :param entry_path: the path to the cache entry directory
+    :param isolate_index_path: the prefix path of the isolate bowtie2 index
+
+    """
+    os.utime(entry_path)
+
+    for path in entry_path.iterdir():
+        shutil.copyfile(path, isolate_index_path.parent / path.name)
+
+
+def update_index_cache(isolate_index_path: Path, cache_path: Path, key: str):
+    """
+    Copy a freshly built bowtie2 index into the cache and evict the oldest entries.
+
+    :param isolate_index_path: the prefix path of the isolate bowtie2 index
+    :param cache_path: the path to the bowtie2 index cache
+    :param key: the cache key for the isolate selection
+
+    """
+    tmp_path = cache_path / f"{key}.tmp"
+    tmp_path.mkdir(parents=True, exist_ok=True)
+
+    for path in isolate_index_path.parent.glob(f"{isolate_index_path.name}.*.bt2"):
+        shutil.copyfile(path, tmp_path / path.name)
+
+    try:
+        os.rename(tmp_path, cache_path / key)
+    except OSError:
+        # Another run sharing the cache stored the same key concurrently. Keep the
+        # existing entry and discard this copy.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    entries = sorted(
+        (path for path in cache_path.iterdir() if not path.name.endswith(".tmp")),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+
+    for path in entries[INDEX_CACHE_SIZE:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+async def run_with_queued_stdout(run, process_batch, maxsize: int = 64):
+    """
+    Run a subprocess while draining its stdout through a bounded queue and worker.
+
+    ``run`` is awaited with a stdout handler that only accumulates raw lines and
+    enqueues full batches on a bounded queue; a worker task drains the queue and
+    awaits ``process_batch`` for each batch. The reader loop stays cheap, so bowtie2
+    does not block writing to its stdout pipe while a batch is being processed.
+
+    A ``process_batch`` failure is re-raised here instead of leaving the reader
+    blocked on a full queue, and the worker task is always awaited or cancelled,
+    even when ``run`` itself raises.
+
+    :param run: a coroutine function awaited with the stdout handler
+    :param process_batch: a coroutine function called with each list of raw lines
+    :param maxsize: the maximum number of batches queued before backpressure
+
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+    lines = []
+
+    async def worker():
+        while True:
+            batch = await queue.get()
+
+            if batch is None:
+                return
+
+            await process_batch(batch)
+
+    worker_task = asyncio.create_task(worker())
+
+    async def put_batch(batch):
+        # Race the put against the worker so a failed worker re-raises its
+        # exception instead of leaving the reader blocked on a full queue.
+        put_task = asyncio.create_task(queue.put(batch))
+
+        await asyncio.wait({put_task, worker_task}, return_when=asyncio.FIRST_COMPLETED)
+
+        if worker_task.done():
+            put_task.cancel()
+            worker_task.result()
+
+    async def stdout_handler(line: bytes):
+        lines.append(line)
+
+        if len(lines) >= SAM_BATCH_SIZE:
+            batch = lines.copy()
+            lines.clear()
+            await put_batch(batch)
+
+    try:
+        await run(stdout_handler)
+
+        if lines:
+            await put_batch(lines.copy())
+            lines.clear()
+
+        await put_batch(None)
+        await worker_task
+    except BaseException:
+        worker_task.cancel()
+
+        try:
+            await worker_task
+        except (Exception, asyncio.CancelledError):
+            pass
+
+        raise
+
+
+def decompress_reads_command(read_file_names: str) -> str:
+    """
+    Build a shell fragment that streams the sample read files to stdout.
+
+    The reads are decompressed with ``gzip -d -c -f``, which passes plain FASTQ
+    through unchanged. Feeding bowtie2 one fused stream on stdin keeps its reader
+    thread saturated instead of stalling between files while it decompresses them
+    itself.
+
+    :param read_file_names: comma-separated paths to the sample read files
+    :return: a shell fragment writing the decompressed reads to stdout
+
+    """
+    paths = " ".join(shlex.quote(name) for name in read_file_names.split(","))
+
+    return f"gzip -d -c -f {paths}"
+
+
+def parse_sam_fields(line: bytes):
+    """
+    Extract the read id, flag, reference id, and alignment score from a SAM line.
+
+    One precompiled pattern captures only the fields the stdout handlers use and a
+    second locates the ``AS:i:`` tag, so the whole line is scanned at regex speed
+    instead of being decoded and split into all ~12 fields.
+
+    :param line: a raw SAM line without its trailing newline
+    :return: the read id, the raw flag field, the reference id, and the alignment
+             score, which is ``None`` when the line carries no ``AS:i:`` tag
+    :raises ValueError: when the line is not a SAM alignment line
+
+    """
+    match = SAM_FIELDS_PATTERN.match(line)
+
+    if match is None:
+        raise ValueError("Malformed SAM line")
+
+    read_id, flag, ref_id, seq = match.group(1, 2, 3, 4)
+
+    score_match = ALIGN_SCORE_PATTERN.search(line, match.end() - 1)
+
+    if score_match is None:
+        score = None
+    else:
+        score = int(score_match.group(1)) + float(len(seq))
+
+    return read_id, flag, ref_id, score
+
 
 @hooks.on_failure
 async def delete_analysis_document(analysis_provider):
@@ -38,7 +254,7 @@ async def map_default_isolates(
     intermediate: SimpleNamespace,
     read_file_names: str,
     index: WFIndex,
-    proc: int,
+    bowtie2_proc: int,
     p_score_cutoff: float,
     run_subprocess: RunSubprocess,
 ):
@@ -49,44 +265,43 @@ async def map_default_isolates(
 
     """
 
-    async def stdout_handler(line: bytes):
-        line = line.decode()
-
-        if line[0] == "#" or line[0] == "@":
-            return
-
-        sam_line = SamLine(line)
-
-        if sam_line.unmapped:
-            return
-
-        if sam_line.ref_id == "*":
-            return
-
-        if sam_line.score < p_score_cutoff:
-            return
-
-        intermediate.to_otus.add(sam_line.ref_id)
+    async def process_batch(batch: List[bytes]):
+        """Filter a batch of SAM lines in Rust and collect their ref ids."""
+        ref_ids = await asyncio.to_thread(
+            rust_utils.collect_sam_ref_ids, b"\n".join(batch), p_score_cutoff
+        )
 
-    await run_subprocess(
-        [
-            "bowtie2",
-            "-p",
-            str(proc),
-            "--no-unal",
-            "--local",
-            "--score-min",
-            "L,20,1.0",
-            "-N",
-            "0",
-            "-L",
-            "15",
-            "-x",
-            str(index.bowtie_path),
-            "-U",
-            read_file_names,
-        ],
-        stdout_handler=stdout_handler,
+        intermediate.to_otus.update(ref_ids)
+
+    bowtie_command = [
+        "bowtie2",
+        "-p",
+        str(bowtie2_proc),
+        "--mm",
+        "--no-unal",
+        "--local",
+        "--score-min",
+        "L,20,1.0",
+        "-N",
+        "0",
+        "-L",
+        "15",
+        "-x",
+        str(index.bowtie_path),
+        "-U",
+        "-",
+    ]
+
+    command = [
+        "bash",
+        "-c",
+        "set -o pipefail; "
+        f"{decompress_reads_command(read_file_names)} | {shlex.join(bowtie_command)}",
+    ]
+
+    await run_with_queued_stdout(
+        lambda stdout_handler: run_subprocess(command, stdout_handler=stdout_handler),
+        process_batch,
     )
 
     logger.info(f"Found {len(intermediate.to_otus)} potential OTUs.")
@@ -100,16 +315,42 @@ async def build_isolate_index(
     isolate_index_path: Path,
     run_subprocess: RunSubprocess,
     proc: int,
+    work_path: Path,
 ):
     """
     Build a mapping index containing all isolates of candidate OTUs.
+
+    Built indexes are cached by a hash of the isolate FASTA content, so reruns with
+    the same isolate sequences skip ``bowtie2-build`` entirely.
     """
+    # Many sequence ids map to the same OTU, so cache the lookups.
+    get_otu_id = lru_cache(maxsize=None)(index.get_otu_id_by_sequence_id)
+
     intermediate.lengths = await index.write_isolate_fasta(
-        [index.get_otu_id_by_sequence_id(id_) for id_ in intermediate.to_otus],
+        [get_otu_id(id_) for id_ in intermediate.to_otus],
         isolate_fasta_path,
         proc,
     )
 
+    cache_path = work_path.parent / "bt2_cache"
+
+    key = await asyncio.to_thread(isolate_index_cache_key, isolate_fasta_path)
+
+    entry_path = cache_path / key
+
+    if (entry_path / f"{isolate_index_path.name}.1.bt2").is_file():
+        try:
+            await asyncio.to_thread(
+                restore_cached_index, entry_path, isolate_index_path
+            )
+        except OSError:
+            # Another run sharing the cache evicted the entry mid-restore. Fall
+            # through and rebuild the index.
+            logger.info("Cached bowtie2 index for key %s disappeared.", key)
+        else:
+            logger.info("Using cached bowtie2 index for key %s.", key)
+            return
+
     await run_subprocess(
         [
             "bowtie2-build",
@@ -120,6 +361,8 @@ async def build_isolate_index(
         ]
     )
 
+    await asyncio.to_thread(update_index_cache, isolate_index_path, cache_path, key)
+
 
 @step
 async def map_isolates(
@@ -129,41 +372,53 @@ async def map_isolates(
     isolate_index_path: Path,
     isolate_sam_path: Path,
     run_subprocess: RunSubprocess,
-    proc: int,
+    bowtie2_proc: int,
     p_score_cutoff: float,
 ):
     """Map sample reads to the all isolate index."""
-    isolate_high_scores = defaultdict(float)
+    # High scores are keyed on the raw bytes read id and decoded once after bowtie2
+    # exits, instead of decoding every read id on every alignment.
+    isolate_high_scores: Dict[bytes, float] = {}
 
-    async with aiofiles.open(isolate_sam_path, "w") as f:
+    parse_fields = parse_sam_fields
 
-        async def stdout_handler(line: bytes):
-            line = line.decode()
+    f = open(isolate_sam_path, "wb")
 
-            if line[0] == "@" or line == "#":
-                return
+    try:
 
-            sam_line = SamLine(line)
+        async def process_batch(batch: List[bytes]):
+            # Accepted lines are joined and written once per batch from a thread.
+            # Dispatching one write per SAM record costs more than the write itself.
+            rows = []
 
-            if sam_line.unmapped:
-                return
+            for line in batch:
+                if line[:1] == b"#" or line[:1] == b"@":
+                    continue
 
-            if sam_line.ref_id == "*":
-                return
+                read_id, flag, ref_id, score = parse_fields(line)
 
-            # Skip if the p_score does not meet the minimum cutoff.
-            if sam_line.score < p_score_cutoff:
-                return
+                # Skip unmapped reads (0x4: segment unmapped) and reads with no
+                # reference.
+                if flag in UNMAPPED_FLAGS or ref_id == b"*":
+                    continue
 
-            if sam_line.score > isolate_high_scores[sam_line.read_id]:
-                isolate_high_scores[sam_line.read_id] = sam_line.score
+                # Skip if the p_score does not meet the minimum cutoff.
+                if score is None or score < p_score_cutoff:
+                    continue
 
-            await f.write(f"{line}\n")
+                if score > isolate_high_scores.get(read_id, 0.0):
+                    isolate_high_scores[read_id] = score
 
-        command = [
+                rows.append(line + b"\n")
+
+            if rows:
+                await asyncio.to_thread(f.write, b"".join(rows))
+
+        bowtie_command = [
             "bowtie2",
             "-p",
-            str(proc),
+            str(bowtie2_proc),
+            "--mm",
             "--no-unal",
             "--local",
             "--score-min",
@@ -179,12 +434,28 @@ async def map_isolates(
             "-x",
             str(isolate_index_path),
             "-U",
-            read_file_names,
+            "-",
         ]
 
-        await run_subprocess(command, stdout_handler=stdout_handler)
+        command = [
+            "bash",
+            "-c",
+            "set -o pipefail; "
+            f"{decompress_reads_command(read_file_names)} | {shlex.join(bowtie_command)}",
+        ]
+
+        await run_with_queued_stdout(
+            lambda stdout_handler: run_subprocess(
+                command, stdout_handler=stdout_handler
+            ),
+            process_batch,
+        )
+    finally:
+        await asyncio.to_thread(f.close)
 
-    intermediate.isolate_high_scores = dict(isolate_high_scores)
+    intermediate.isolate_high_scores = {
+        read_id.decode(): score for read_id, score in isolate_high_scores.items()
+    }
 
 
 def read_fastq_grouped_lines(fastq_file: TextIO):
@@ -212,12 +483,16 @@ def subtract_fastq(
             if record[0].strip("@\n") not in subtracted_reads:
                 new_fastq_file.write("".join(record))
 
+    # Move the reduced FASTQ over the current one, saving the caller a second full
+    # pass copying it back.
+    os.replace(new_fastq_path, current_fastq_path)
+
 
 @step
 async def eliminate_subtraction(
     isolate_fastq_path: Path,
     isolate_sam_path: Path,
-    proc: int,
+    bowtie2_proc: int,
     results: Dict[str, Any],
     run_subprocess: RunSubprocess,
     subtractions: List[WFSubtraction],
@@ -239,7 +514,7 @@ async def eliminate_subtraction(
 
     :param isolate_fastq_path: path to the FASTQ file containing reads that aligned to the isolates
     :param isolate_sam_path: path to the SAM file of alignments to the isolates
-    :param proc: number of processors to use
+    :param bowtie2_proc: number of processors to use for bowtie2 alignment
     :param results: the results to send to the api when the workflow is complete
     :param run_subprocess: runs a subprocess with error handling
     :param subtractions: the subtraction to align and eliminate reads against
@@ -261,11 +536,14 @@ async def eliminate_subtraction(
 
     subtracted_count = 0
 
-    for subtraction in subtractions:
+    working_isolate_path = work_path / "working_isolate.sam"
+
+    for i, subtraction in enumerate(subtractions):
         # Map reads to the subtraction.
         await run_subprocess(
             [
                 "bowtie2",
+                "--mm",
                 "--local",
                 "--no-unal",
                 "--no-hd",
@@ -273,7 +551,7 @@ async def eliminate_subtraction(
                 "-N",
                 "0",
                 "-p",
-                str(proc),
+                str(bowtie2_proc),
                 "-x",
                 shlex.quote(str(subtraction.bowtie2_index_path)),
                 "-U",
@@ -289,13 +567,21 @@ async def eliminate_subtraction(
             str(subtracted_sam_path),
         )
 
-        await aiofiles.os.remove(to_subtraction_sam_path)
-
-        # set next iteration's current isolate file to the newly created isolate file
-        current_isolate_path = work_path / "working_isolate.sam"
-        await asyncio.to_thread(
-            shutil.copyfile, subtracted_sam_path, current_isolate_path
-        )
+        if i < len(subtractions) - 1:
+            # Rename the subtracted SAM into place as the next iteration's isolate
+            # file instead of copying it; rust_utils recreates subtracted_sam_path
+            # on the next pass. Removing the subtraction SAM is independent, so run
+            # it concurrently.
+            current_isolate_path = working_isolate_path
+
+            await asyncio.gather(
+                aiofiles.os.remove(to_subtraction_sam_path),
+                asyncio.to_thread(
+                    os.replace, subtracted_sam_path, working_isolate_path
+                ),
+            )
+        else:
+            await aiofiles.os.remove(to_subtraction_sam_path)
 
         subtracted_reads = {}
 
@@ -304,15 +590,12 @@ async def eliminate_subtraction(
 
         subtracted_count += len(subtracted_reads)
 
+        # Rewrite the fastq file to exclude subtracted reads. subtract_fastq moves
+        # the reduced file over current_fastq_path itself.
         await asyncio.to_thread(
             subtract_fastq, current_fastq_path, new_fastq_path, subtracted_reads
         )
 
-        # rewrite the fastq file to exclude previous reads
-
-        # set next iteration's current fastq file to newly created fastq file
-        await asyncio.to_thread(shutil.copyfile, new_fastq_path, current_fastq_path)
-
         logger.info(
             "Subtracted %s reads that mapped better to a subtraction.", subtracted_count
         )
@@ -363,6 +646,12 @@ async def reassignment(
 
     report_path = work_path / "report.tsv"
 
+    # Start coverage calculation now so it overlaps with report writing. Both only
+    # need the reassigned SAM file, which exists once run_pathoscope returns.
+    coverage_task = asyncio.create_task(
+        asyncio.to_thread(calculate_coverage, reassigned_path, intermediate.lengths)
+    )
+
     report = await asyncio.to_thread(
         write_report,
         report_path,
@@ -382,32 +671,46 @@ async def reassignment(
 
     analysis.upload(report_path, "tsv")
 
-    intermediate.coverage = await asyncio.to_thread(
-        calculate_coverage, reassigned_path, intermediate.lengths
-    )
-
-    hits = list()
-
-    for sequence_id, hit in report.items():
-        otu_id = index.get_otu_id_by_sequence_id(sequence_id)
-
-        hit["id"] = sequence_id
+    intermediate.coverage = await coverage_task
 
-        # Attach "otu" (id, version) to the hit.
-        hit["otu"] = {"id": otu_id, "version": index.manifest[otu_id]}
+    # Many sequence ids map to the same OTU, so cache the lookups.
+    get_otu_id = lru_cache(maxsize=None)(index.get_otu_id_by_sequence_id)
 
-        # Get the coverage for the sequence.
-        hit_coverage = intermediate.coverage[sequence_id]
+    # Snapshot the manifest so each hit does a plain dict lookup instead of going
+    # through the index attribute.
+    manifest = dict(index.manifest)
 
-        hit["align"] = hit_coverage
+    # Build the hit columns first, then materialize the hit dicts in one pass. This
+    # keeps the numeric columns in NumPy arrays until the final zip.
+    sequence_ids = list(report)
+    otu_ids = [get_otu_id(sequence_id) for sequence_id in sequence_ids]
+    coverages = [intermediate.coverage[sequence_id] for sequence_id in sequence_ids]
 
-        # Calculate coverage and attach to hit.
-        hit["coverage"] = round(1 - hit_coverage.count(0) / len(hit_coverage), 3)
-
-        # Calculate depth and attach to hit.
-        hit["depth"] = round(sum(hit_coverage) / len(hit_coverage))
-
-        hits.append(hit)
+    # Compute coverage fractions and depths for all hits in a few array operations
+    # instead of two rounded Python divisions per hit.
+    sizes = numpy.fromiter((cov.size for cov in coverages), dtype=numpy.float64)
+    nonzero_counts = numpy.fromiter(
+        (numpy.count_nonzero(cov) for cov in coverages), dtype=numpy.float64
+    )
+    sums = numpy.fromiter((cov.sum() for cov in coverages), dtype=numpy.float64)
+
+    coverage_fractions = numpy.round(nonzero_counts / sizes, 3)
+    depths = numpy.rint(sums / sizes)
+
+    hits = [
+        {
+            **report[sequence_id],
+            "id": sequence_id,
+            # Attach "otu" (id, version) to the hit.
+            "otu": {"id": otu_id, "version": manifest[otu_id]},
+            "align": coverage.tolist(),
+            "coverage": float(coverage_fraction),
+            "depth": int(depth),
+        }
+        for sequence_id, otu_id, coverage, coverage_fraction, depth in zip(
+            sequence_ids, otu_ids, coverages, coverage_fractions, depths
+        )
+    ]
 
     results.update({"read_count": read_count, "hits": hits})
 